@@ -1,8 +1,12 @@
 import streamlit as st
 import piexif
-from PIL import Image
+from PIL import Image, ImageOps
 import io
+import os
 import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta
 
 # --- CONSTANTS ---
@@ -29,6 +33,8 @@ PRESET_LOCATIONS = {
     "Foristell, MO": (38.8170, -90.9387),
 }
 
+LOCATION_LIST = tuple({"name": k, "lat": v[0], "lng": v[1]} for k, v in PRESET_LOCATIONS.items())
+
 SERVICES_LIST = [
     "House Wash",
     "Gutter Cleaning",
@@ -38,6 +44,15 @@ SERVICES_LIST = [
     "Concrete Cleaning"
 ]
 
+_NON_ALNUM = re.compile(r'[^A-Za-z0-9]+')
+
+def sanitize_name(name):
+    """Collapse every run of non-alphanumeric characters into a single hyphen."""
+    return _NON_ALNUM.sub("-", name).strip("-")
+
+SAFE_SERVICES = {s: sanitize_name(s) for s in SERVICES_LIST}
+SAFE_LOCATIONS = {k: sanitize_name(k) for k in PRESET_LOCATIONS}
+
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="SEO Photo Batcher", layout="wide")
 
@@ -65,25 +80,38 @@ if not check_password():
 
 # --- HELPER FUNCTIONS ---
 
-def get_random_weekday_date(start, end):
-    """Generate a random datetime between start and end, excluding Weekends."""
-    while True:
-        delta = end - start
-        int_delta = (delta.days * 24 * 60 * 60) + delta.seconds
-        random_second = random.randrange(int_delta)
-        res = start + timedelta(seconds=random_second)
-        
-        # weekday(): 0=Mon, 4=Fri, 5=Sat, 6=Sun
-        if res.weekday() < 5:
-            # Force business hours (8 AM to 6 PM)
-            return res.replace(hour=random.randint(8, 18), minute=random.randint(0, 59))
+def get_weekdays(start, end):
+    """List the weekday dates (as midnight datetimes) from start up to, not including, end."""
+    # weekday(): 0=Mon, 4=Fri, 5=Sat, 6=Sun
+    days = (start + timedelta(days=n) for n in range((end - start).days))
+    return [d for d in days if d.weekday() < 5]
+
+def get_random_weekday_date(weekdays):
+    """Generate a random datetime on one of the given weekdays."""
+    # Pick uniformly among the weekdays directly instead of rejecting weekend draws
+    res = weekdays[random.randrange(len(weekdays))]
+    
+    # Force business hours (8 AM to 6 PM)
+    return res.replace(hour=random.randint(8, 18), minute=random.randint(0, 59), second=random.randint(0, 59))
 
+@lru_cache(maxsize=None)
 def dec_to_dms(deg):
     """Convert decimal degrees to DMS format for EXIF."""
-    d = int(deg)
-    m = int((deg - d) * 60)
-    s = (deg - d - m/60) * 3600 * 100
-    return ((d, 1), (m, 1), (int(s), 100))
+    # Work in integer hundredths of an arc-second to avoid float cancellation
+    total = int(round(deg * 3600 * 100))
+    d, rem = divmod(total, 3600 * 100)
+    m, s = divmod(rem, 60 * 100)
+    return ((d, 1), (m, 1), (s, 100))
+
+@lru_cache(maxsize=None)
+def build_gps_ifd(lat, lng):
+    """Build the EXIF GPS block for a location. Cached, since locations come from a fixed preset list."""
+    return {
+        piexif.GPSIFD.GPSLatitudeRef: 'N' if lat >= 0 else 'S',
+        piexif.GPSIFD.GPSLatitude: dec_to_dms(abs(lat)),
+        piexif.GPSIFD.GPSLongitudeRef: 'E' if lng >= 0 else 'W',
+        piexif.GPSIFD.GPSLongitude: dec_to_dms(abs(lng)),
+    }
 
 def dms_to_dec(dms_ref, dms_list):
     """Helper to convert EXIF DMS to decimal for comparison."""
@@ -102,11 +130,9 @@ def get_original_group_key(image_bytes):
     Photos with the same Key will get the same random assignment.
     """
     try:
-        img = Image.open(io.BytesIO(image_bytes))
-        if 'exif' not in img.info:
-            return None # No EXIF, treat as unique
-        
-        exif_dict = piexif.load(img.info['exif'])
+        # piexif reads the APP1 segment straight from the bytes, no PIL decode.
+        # Non-JPEG uploads raise here and fall through to None (unique).
+        exif_dict = piexif.load(image_bytes)
         
         # 1. Get Date (YYYY:MM:DD)
         date_str = exif_dict.get("Exif", {}).get(piexif.ExifIFD.DateTimeOriginal)
@@ -134,55 +160,169 @@ def get_original_group_key(image_bytes):
         if date_str == "NoDate" and lat == 0.0:
             return None
             
-        return f"{date_str}_{lat}_{lng}"
+        return (date_str, lat, lng)
         
     except Exception:
         return None
 
-def process_single_image(image_bytes, service_name, location_data, date_obj):
+def update_service(file_key):
+    """Selectbox callback: store the newly picked service on the file's assignment."""
+    st.session_state.assignments[file_key]['service'] = st.session_state[f"svc_{file_key}"]
+
+def is_jpeg(image_bytes):
+    """JPEG files start with the SOI marker followed by another marker."""
+    return image_bytes[:3] == b"\xff\xd8\xff"
+
+def build_output(image_bytes, data, optimize):
+    """Process one photo for its assignment and package the result as a processed_cache entry."""
+    name, final_bytes, spliced = process_single_image(
+        image_bytes, data['service'], data['loc'], data['date'], optimize=optimize
+    )
+    return {
+        "inputs": (data['service'], data['loc']['name'], data['date']),
+        "optimize": optimize,
+        "spliced": spliced,
+        "name": name,
+        "bytes": final_bytes
+    }
+
+def output_is_current(entry, data, optimize):
+    """Whether a processed_cache entry still matches the photo's assignment and settings."""
+    if not entry or entry['inputs'] != (data['service'], data['loc']['name'], data['date']):
+        return False
+    # Spliced JPEGs are never re-encoded, so the optimize flag can't have changed them
+    return entry['spliced'] or entry['optimize'] == optimize
+
+def make_thumbnail(image_bytes, size=(400, 400)):
+    """Small JPEG preview for the gallery, so reruns don't re-send the full upload."""
+    # Cameras/phones usually embed a small JPEG preview in EXIF - use it when it
+    # needs no rotation, skipping the full-image decode entirely
+    try:
+        exif_dict = piexif.load(image_bytes)
+    except Exception:
+        exif_dict = {}
+    orientation = exif_dict.get("0th", {}).get(piexif.ImageIFD.Orientation, 1)
+    if exif_dict.get("thumbnail") and orientation == 1:
+        return exif_dict["thumbnail"]
+    
     img = Image.open(io.BytesIO(image_bytes))
+    img.thumbnail(size) # JPEGs decode at reduced scale via draft mode
+    img = ImageOps.exif_transpose(img) # Thumbnail drops EXIF, so bake in the rotation
+    if img.mode != "RGB":
+        img = img.convert("RGB")
     
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=70)
+    return output.getvalue()
+
+def split_jpeg_segments(jpeg_bytes):
+    """
+    Split a JPEG into its header segments (SOI excluded) and the scan data from SOS onward.
+    Fill bytes between markers are dropped. Raises ValueError on anything malformed.
+    """
+    if jpeg_bytes[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG")
+    segments = []
+    pos = 2
+    while True:
+        # Skip fill bytes between markers
+        while jpeg_bytes[pos + 1] == 0xFF:
+            pos += 1
+        if jpeg_bytes[pos] != 0xFF:
+            raise ValueError("Malformed JPEG marker")
+        
+        if jpeg_bytes[pos + 1] == 0xDA: # Start of Scan: everything after is image data
+            return segments, jpeg_bytes[pos:]
+        
+        length = int.from_bytes(jpeg_bytes[pos + 2:pos + 4], "big")
+        segment = jpeg_bytes[pos:pos + 2 + length]
+        if length < 2 or len(segment) != 2 + length:
+            raise ValueError("Truncated JPEG segment")
+        segments.append(segment)
+        pos += 2 + length
+
+def is_metadata_segment(segment):
+    """EXIF or XMP (APP1) and IPTC/Photoshop (APP13) segments - all can carry capture date and GPS."""
+    if segment[:2] == b"\xff\xed":
+        return True
+    return segment[:2] == b"\xff\xe1" and (
+        segment[4:10] == b"Exif\x00\x00" or segment[4:].startswith(b"http://ns.adobe.com/")
+    )
+
+def strip_metadata_segments(jpeg_bytes):
+    """
+    Drop every EXIF, XMP and IPTC segment from a JPEG, wherever it sits in the header.
+    piexif.insert only replaces an EXIF block in the first slot (or right after JFIF),
+    so any other layout would keep the original date and location next to the new one.
+    """
+    segments, scan = split_jpeg_segments(jpeg_bytes)
+    kept = [seg for seg in segments if not is_metadata_segment(seg)]
+    return b"".join([b"\xff\xd8", *kept, scan])
+
+def process_single_image(image_bytes, service_name, location_data, date_obj, optimize=False):
     # 1. Prepare EXIF Data
-    exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
     datestr = date_obj.strftime("%Y:%m:%d %H:%M:%S")
-    exif_dict["0th"][piexif.ImageIFD.DateTime] = datestr
-    exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = datestr
-    exif_dict["Exif"][piexif.ExifIFD.DateTimeDigitized] = datestr
-
+    gps_ifd = {}
     if location_data and location_data.get('lat'):
-        lat = location_data['lat']
-        lng = location_data['lng']
-        exif_dict["GPS"][piexif.GPSIFD.GPSLatitudeRef] = 'N' if lat >= 0 else 'S'
-        exif_dict["GPS"][piexif.GPSIFD.GPSLatitude] = dec_to_dms(abs(lat))
-        exif_dict["GPS"][piexif.GPSIFD.GPSLongitudeRef] = 'E' if lng >= 0 else 'W'
-        exif_dict["GPS"][piexif.GPSIFD.GPSLongitude] = dec_to_dms(abs(lng))
+        gps_ifd = dict(build_gps_ifd(location_data['lat'], location_data['lng']))
 
+    # Start from the original EXIF so camera tags (make, model, orientation...) survive.
+    # Some camera EXIF won't round-trip through piexif.dump, so fall back to a blank one.
+    candidates = []
     try:
-        exif_bytes = piexif.dump(exif_dict)
+        candidates.append(piexif.load(image_bytes))
     except Exception:
-        exif_bytes = None
+        pass
+    candidates.append({"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None})
+
+    exif_bytes = None
+    for exif_dict in candidates:
+        exif_dict["0th"][piexif.ImageIFD.DateTime] = datestr
+        exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = datestr
+        exif_dict["Exif"][piexif.ExifIFD.DateTimeDigitized] = datestr
+        # Replace the whole GPS block so no original location/timestamp tags leak through
+        exif_dict["GPS"] = gps_ifd
+        try:
+            exif_bytes = piexif.dump(exif_dict)
+            break
+        except Exception:
+            continue
 
     # 2. Save Image
     output = io.BytesIO()
-    if img.mode in ("RGBA", "P"):
-        img = img.convert("RGB")
-        
-    if exif_bytes:
-        img.save(output, format="JPEG", exif=exif_bytes, quality=95)
-    else:
-        img.save(output, format="JPEG", quality=95)
+    spliced = False
+    if exif_bytes and is_jpeg(image_bytes):
+        # Already a JPEG: splice in the new EXIF, no decode/re-encode.
+        # piexif's segment parser is stricter than Pillow, so re-encode if it rejects the file.
+        try:
+            piexif.insert(exif_bytes, strip_metadata_segments(image_bytes), output)
+            segments, _ = split_jpeg_segments(output.getvalue())
+            if sum(seg[:2] == b"\xff\xe1" and seg[4:10] == b"Exif\x00\x00" for seg in segments) != 1:
+                raise ValueError("Spliced JPEG must carry exactly one EXIF segment")
+            spliced = True
+        except Exception:
+            output = io.BytesIO()
+    
+    if not spliced:
+        img = Image.open(io.BytesIO(image_bytes))
+        if img.mode in ("RGBA", "P"):
+            img = img.convert("RGB")
+            
+        # optimize/progressive trade a little CPU for a few % smaller files
+        save_kwargs = {"quality": 95, "optimize": optimize, "progressive": optimize}
+        if exif_bytes:
+            img.save(output, format="JPEG", exif=exif_bytes, **save_kwargs)
+        else:
+            img.save(output, format="JPEG", **save_kwargs)
     
     # 3. Create Clean Filename
-    safe_service = "".join([c if c.isalnum() else "-" for c in service_name])
-    safe_loc = "".join([c if c.isalnum() else "-" for c in location_data['name']])
+    safe_service = SAFE_SERVICES.get(service_name) or sanitize_name(service_name)
+    safe_loc = SAFE_LOCATIONS.get(location_data['name']) or sanitize_name(location_data['name'])
     safe_date = date_obj.strftime("%m-%d-%Y")
     
-    while "--" in safe_service: safe_service = safe_service.replace("--", "-")
-    while "--" in safe_loc: safe_loc = safe_loc.replace("--", "-")
-    
     new_filename = f"{safe_service}-{safe_loc}-{safe_date}.jpg"
     
-    return new_filename, output.getvalue()
+    return new_filename, output.getvalue(), spliced
 
 # --- MAIN APP UI ---
 
@@ -199,6 +339,12 @@ with st.sidebar:
     
     default_service = st.selectbox("Default Service", SERVICES_LIST)
     
+    optimize_jpeg = st.checkbox(
+        "Optimize JPEG (smaller, slower)",
+        help="Uses optimized Huffman tables and progressive encoding for re-encoded uploads (PNG). "
+             "JPEG uploads keep their original compressed data. Off is the fast path."
+    )
+    
     st.info(f"Loaded {len(PRESET_LOCATIONS)} Missouri Locations.")
 
 # File Uploader
@@ -209,20 +355,44 @@ if "assignments" not in st.session_state:
     st.session_state.assignments = {} # Key: filename -> data
 if "group_cache" not in st.session_state:
     st.session_state.group_cache = {} # Key: origin_group_key -> {date, loc}
+if "processed_cache" not in st.session_state:
+    st.session_state.processed_cache = {} # Key: file_key -> latest output (see build_output)
+if "thumbs" not in st.session_state:
+    st.session_state.thumbs = {} # Key: file_key -> preview JPEG bytes
+
+# Drop cached output and previews for files that have been removed from the uploader
+current_file_keys = {f"{f.name}_{f.size}" for f in uploaded_files or []}
+st.session_state.processed_cache = {
+    k: v for k, v in st.session_state.processed_cache.items() if k in current_file_keys
+}
+st.session_state.thumbs = {
+    k: v for k, v in st.session_state.thumbs.items() if k in current_file_keys
+}
 
 if uploaded_files:
     st.divider()
     
-    location_list = [{"name": k, "lat": v[0], "lng": v[1]} for k, v in PRESET_LOCATIONS.items()]
+    # Read each upload once per rerun and reuse the bytes for grouping and processing
+    raw_bytes = {f"{f.name}_{f.size}": f.getvalue() for f in uploaded_files}
+    
+    # Valid dates for new assignments, computed once per rerun rather than per draw
+    weekdays = get_weekdays(
+        datetime.combine(start_date, datetime.min.time()),
+        datetime.combine(end_date, datetime.min.time())
+    )
+    missing_weekdays = False
     
     for uploaded_file in uploaded_files:
         file_key = f"{uploaded_file.name}_{uploaded_file.size}"
         
+        if file_key not in st.session_state.thumbs:
+            st.session_state.thumbs[file_key] = make_thumbnail(raw_bytes[file_key])
+        
         # Only process if we haven't assigned this specific file yet
         if file_key not in st.session_state.assignments:
             
             # 1. Analyze Original EXIF to see if it belongs to a group
-            origin_group_key = get_original_group_key(uploaded_file.getvalue())
+            origin_group_key = get_original_group_key(raw_bytes[file_key])
             
             assigned_date = None
             assigned_loc = None
@@ -234,12 +404,14 @@ if uploaded_files:
                 assigned_date = cached['date']
                 assigned_loc = cached['loc']
             else:
+                if not weekdays:
+                    # No date to draw - leave this photo unassigned until the range is fixed
+                    missing_weekdays = True
+                    continue
+                
                 # Generate NEW randoms
-                assigned_date = get_random_weekday_date(
-                    datetime.combine(start_date, datetime.min.time()),
-                    datetime.combine(end_date, datetime.min.time())
-                )
-                assigned_loc = random.choice(location_list)
+                assigned_date = get_random_weekday_date(weekdays)
+                assigned_loc = random.choice(LOCATION_LIST)
                 
                 # If this file has a valid group key, save these randoms for the next file in the group
                 if origin_group_key:
@@ -255,6 +427,35 @@ if uploaded_files:
                 "service": default_service
             }
 
+    if missing_weekdays:
+        st.error("📅 The date range has no weekdays, so new photos can't be assigned a date. The End Date must come after the Start Date, and the range must include a Monday–Friday.")
+
+    # Process every photo that isn't cached yet. JPEG uploads only get their EXIF
+    # spliced, which is pure Python and holds the GIL, so they run inline. Uploads
+    # that need a Pillow re-encode go to a thread pool, since libjpeg releases the GIL.
+    # Only plain data goes to the workers; all Streamlit calls stay on this thread.
+    to_splice = {}
+    to_encode = {}
+    for uploaded_file in uploaded_files:
+        file_key = f"{uploaded_file.name}_{uploaded_file.size}"
+        data = st.session_state.assignments.get(file_key)
+        if data:
+            # One entry per file: a changed service/flag overwrites the previous output
+            if not output_is_current(st.session_state.processed_cache.get(file_key), data, optimize_jpeg):
+                pending = to_splice if is_jpeg(raw_bytes[file_key]) else to_encode
+                pending[file_key] = (raw_bytes[file_key], data)
+
+    for file_key, (raw, data) in to_splice.items():
+        st.session_state.processed_cache[file_key] = build_output(raw, data, optimize_jpeg)
+
+    if to_encode:
+        with ThreadPoolExecutor(max_workers=min(len(to_encode), os.cpu_count() or 1)) as executor:
+            results = executor.map(
+                lambda args: build_output(*args, optimize_jpeg),
+                to_encode.values()
+            )
+            st.session_state.processed_cache.update(zip(to_encode, results))
+
     # Display Gallery
     for i, uploaded_file in enumerate(uploaded_files):
         file_key = f"{uploaded_file.name}_{uploaded_file.size}"
@@ -264,31 +465,27 @@ if uploaded_files:
             with st.container():
                 c1, c2 = st.columns([1, 2])
                 with c1:
-                    st.image(uploaded_file, use_container_width=True)
+                    st.image(st.session_state.thumbs[file_key], use_container_width=True)
                 
                 with c2:
                     st.markdown(f"**Photo {i+1}**")
                     
-                    new_service = st.selectbox(
+                    # The callback updates the assignment before the rerun, so the
+                    # processing pass above already sees the new service
+                    st.selectbox(
                         "Service Type", 
                         SERVICES_LIST, 
                         index=SERVICES_LIST.index(data['service']) if data['service'] in SERVICES_LIST else 0,
-                        key=f"svc_{file_key}"
+                        key=f"svc_{file_key}",
+                        on_change=update_service,
+                        args=(file_key,)
                     )
-                    
-                    if new_service != data['service']:
-                        st.session_state.assignments[file_key]['service'] = new_service
-                        st.rerun()
 
                     st.caption(f"📍 **{data['loc']['name']}**")
                     st.caption(f"📅 **{data['date'].strftime('%A, %m-%d-%Y')}**") # Added Day Name to verify No Weekends
 
-                    final_name, final_bytes = process_single_image(
-                        uploaded_file.getvalue(),
-                        new_service,
-                        data['loc'],
-                        data['date']
-                    )
+                    output = st.session_state.processed_cache[file_key]
+                    final_name, final_bytes = output['name'], output['bytes']
                     
                     st.markdown(f"File: `{final_name}`")
 